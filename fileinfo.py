@@ -7,43 +7,410 @@
 # License: MIT License
 #
 
+import errno
+import functools
 import os
+import re
+import stat
+import struct
+import sys
+import threading
+from collections import deque
 
-def get_f_size(f_path,f_unit):
-    f_size = os.path.getsize(f_path)
-    if 'Byte' in f_unit:
-        f_out = str(f_size) + 'Bytes'
-    elif 'KB' in f_unit:
-        f_out = str(f_size / 1024) + 'KB'
-    elif 'MB' in f_unit:
-        f_out = '%.2fMB' % (f_size / (1024.0 * 1024.0))
-    return f_out
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import liburing
+except ImportError:
+    liburing = None
+
+# Divisor and format of the units printed with two decimals
+f_units = { 'mb': (1048576.0, '%.2fMB'), 'gb': (1073741824.0, '%.2fGB'), 'tb': (1099511627776.0, '%.2fTB') }
+
+# Return a size formatter for the unit; sizes under 8 KiB are memoised
+def get_f_fmt(f_unit):
+    unit = f_unit.lower()
+    if unit in ('byte', 'bytes'):
+        fmt = lambda f_size: str(f_size) + 'Bytes'
+    elif unit == 'kb':
+        fmt = lambda f_size: str(f_size / 1024) + 'KB'
+    elif unit in f_units:
+        div, pattern = f_units[unit]
+        fmt = lambda f_size: pattern % (f_size / div)
+    else:
+        raise ValueError('Unknown f_unit: ' + f_unit)
+    cached = functools.lru_cache(maxsize=None)(fmt)
+    return lambda f_size: cached(f_size) if f_size < 8192 else fmt(f_size)
+
+# Report an entry that could not be read; files removed mid-scan are ignored
+def _skip(f_path, e):
+    if e.errno == errno.ENOENT:
+        return
+    with _stats_lock:
+        _stats[1] += 1
+    if _quiet:
+        return
+    elif e.errno == errno.EACCES:
+        print('Permission denied: ' + f_path, file=sys.stderr)
+    else:
+        print('Error: ' + f_path + ': ' + e.strerror, file=sys.stderr)
+
+# List one directory: (path prefix, [ (name, size) ], [ subdirectories ]).
+# Sizes are looked up relative to the directory fd where scandir accepts one
+def scan_dir(d_path, strict=False):
+    files = []
+    dirs = []
+    names = []
+    add_file = files.append
+    add_dir = dirs.append
+    add_name = names.append
+    batch = _uring or _cached_stat
+    d_pre = os.path.join(d_path, '')
+    try:
+        fd = os.open(d_path, os.O_RDONLY | os.O_DIRECTORY) if _fd_scan else None
+        try:
+            with os.scandir(d_path if fd is None else fd) as it:
+                # Files first: they far outnumber directories
+                for entry in it:
+                    name = entry.name
+                    if entry.is_file(follow_symlinks=False):
+                        if batch:
+                            add_name(name)
+                        else:
+                            try:
+                                add_file((name, entry.stat(follow_symlinks=False).st_size))
+                            except OSError as e:
+                                _skip(d_pre + name, e)
+                    elif entry.is_dir(follow_symlinks=False) and name not in inv_dirs:
+                        if inv_dir_sfx and name.endswith(inv_dir_sfx):
+                            continue
+                        if dir_match is None or not dir_match(d_pre + name + os.sep):
+                            add_dir(d_pre + name)
+            if batch:
+                if _uring:
+                    sizes = _statx_batch(fd, names, d_pre)
+                else:
+                    sizes = [ _statx_size(fd, name, d_pre) for name in names ]
+                files = [ (name, f_size) for name, f_size in zip(names, sizes) if f_size is not None ]
+        finally:
+            if fd is not None:
+                os.close(fd)
+    except OSError as e:
+        if strict:
+            raise
+        _skip(d_path, e)
+    return d_pre, files, dirs
+
+# Stat names through io_uring, 256 per submit, one ring per worker thread.
+# Entries that failed or are not regular files are None
+def _statx_batch(fd, names, d_pre):
+    ring = getattr(_local, 'ring', None)
+    if ring is None:
+        ring = liburing.Ring()
+        liburing.io_uring_queue_init(256, ring, 0)
+        with _rings_lock:
+            _rings.append(ring)
+        _local.ring = ring
+    cqe = liburing.Cqe()
+    sizes = [ None ] * len(names)
+    for i in range(0, len(names), 256):
+        bufs = {}
+        for j in range(i, min(i + 256, len(names))):
+            name = names[j]
+            # liburing rejects undecodable names (surrogate escapes)
+            if not name.isascii():
+                try:
+                    name.encode()
+                except UnicodeEncodeError:
+                    try:
+                        st = os.stat(name, dir_fd=fd, follow_symlinks=False)
+                        if stat.S_ISREG(st.st_mode):
+                            sizes[j] = st.st_size
+                    except OSError as e:
+                        _skip(d_pre + name, e)
+                    continue
+            buf = bufs[j] = liburing.Statx()
+            sqe = liburing.io_uring_get_sqe(ring)
+            liburing.io_uring_prep_statx(sqe, buf, name, _statx_flags,
+                                         liburing.STATX_TYPE | liburing.STATX_SIZE, fd)
+            sqe.user_data = j
+        if not bufs:
+            continue
+        liburing.io_uring_submit(ring)
+        liburing.io_uring_wait_cqe_nr(ring, cqe, len(bufs))
+        # user_data is the name's index; res raises on a failed statx
+        failed = []
+        for _ in liburing.CqeIter(ring, cqe):
+            entry = cqe[0]
+            try:
+                entry.res
+            except OSError as e:
+                failed.append((entry.user_data, e))
+        liburing.io_uring_cq_advance(ring, len(bufs))
+        for j, e in failed:
+            del bufs[j]
+            _skip(d_pre + names[j], e)
+        for j, buf in bufs.items():
+            if buf.isreg:
+                sizes[j] = buf.size
+    return sizes
+
+# Stat one name with libc statx(), for --cached-stat without io_uring
+def _statx_size(fd, name, d_pre):
+    buf = getattr(_local, 'statx', None)
+    if buf is None:
+        buf = _local.statx = ctypes.create_string_buffer(256)
+    if _libc_statx(fd, os.fsencode(name), _statx_flags, 0x201, buf) != 0:
+        err = ctypes.get_errno()
+        _skip(d_pre + name, OSError(err, os.strerror(err)))
+        return None
+    mode, f_size = _statx_unpack(buf)
+    return f_size if stat.S_ISREG(mode) else None
+
+# Close the rings opened by this run's scans
+def _close_rings():
+    with _rings_lock:
+        for ring in _rings:
+            liburing.io_uring_queue_exit(ring)
+        _rings.clear()
+    _local.ring = None
+
+# Load libc statx() on first use, so ctypes is only imported for --cached-stat
+def _load_statx():
+    global ctypes, _libc_statx
+    if _libc_statx is None and sys.platform.startswith('linux'):
+        import ctypes
+        _libc_statx = getattr(ctypes.CDLL(None, use_errno=True), 'statx', None)
+    return _libc_statx is not None
+
+# io_uring can be compiled in but blocked (old kernel, seccomp), so probe once
+def _uring_ok():
+    if not sys.platform.startswith('linux'):
+        return False
+    # IORING_OP_STATX needs Linux 5.6
+    release = re.match(r'(\d+)\.(\d+)', os.uname().release)
+    if not release or (int(release.group(1)), int(release.group(2))) < (5, 6):
+        return False
+    ring = liburing.Ring()
+    try:
+        liburing.io_uring_queue_init(1, ring, 0)
+    except OSError:
+        return False
+    liburing.io_uring_queue_exit(ring)
+    return True
+
+# Write a whole buffer to fd, finishing any short writes
+def write_all(fd, data):
+    data = memoryview(data)
+    while data:
+        data = data[os.write(fd, data):]
+
+# One matcher for all patterns: Aho-Corasick if installed, else a regex
+def get_inv_match(patterns):
+    if not patterns:
+        return None
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for x in patterns:
+            automaton.add_word(x, x)
+        automaton.make_automaton()
+        find = automaton.iter
+        return lambda s: next(find(s), None) is not None
+    return re.compile('|'.join(map(re.escape, patterns))).search
+
+USAGE = '''usage: fileinfo.py [-d DIR] [-u UNIT] [-o FILE] [-e PATTERN]... [-j N]
+                   [--cached-stat] [--stats] [-q]
+
+  -d, --directory DIR     directory to scan (default: r_dir)
+  -u, --unit UNIT         Byte, KB, MB, GB or TB (default: f_unit)
+  -o, --output FILE       output file (default: DIR/fileinfo.txt)
+  -e, --exclude PATTERN   skip matching files (see README), repeatable;
+                          replaces the invaild list
+  -j, --jobs N            directories listed in parallel
+                          (default: min(32, 4 * CPUs))
+  --cached-stat           accept cached file sizes on network filesystems
+                          (Linux statx AT_STATX_DONT_SYNC)
+  --stats                 print how many files were listed and unreadable
+  -q, --quiet             do not report unreadable files
+'''
+
+_argv_opts = { '-d': 'directory', '--directory': 'directory', '-u': 'unit', '--unit': 'unit',
+               '-o': 'output', '--output': 'output', '-e': 'exclude', '--exclude': 'exclude',
+               '-j': 'jobs', '--jobs': 'jobs' }
+
+# Parse the few options by hand (argparse is slow to import)
+def parse_argv(argv):
+    opts = {}
+    args = iter(argv)
+    for arg in args:
+        name, eq, value = arg.partition('=') if arg.startswith('--') else (arg, '', '')
+        if name in ('-h', '--help'):
+            print(USAGE, end='')
+            sys.exit(0)
+        elif name in ('-q', '--quiet'):
+            opts['quiet'] = True
+        elif name == '--cached-stat':
+            opts['cached_stat'] = True
+        elif name == '--stats':
+            opts['stats'] = True
+        elif name in _argv_opts:
+            if not eq:
+                value = next(args, None)
+                if value is None:
+                    sys.exit('fileinfo.py: ' + name + ' needs a value\n' + USAGE.rstrip())
+            if _argv_opts[name] == 'exclude':
+                opts.setdefault('exclude', []).append(value)
+            else:
+                opts[_argv_opts[name]] = value
+        else:
+            sys.exit('fileinfo.py: unknown option ' + arg + '\n' + USAGE.rstrip())
+    return opts
+
+_local = threading.local()
+# Files listed and entries that could not be read, for --stats
+_stats = [ 0, 0 ]
+_stats_lock = threading.Lock()
+# io_uring rings of every scan thread, closed at the end of main()
+_rings = []
+_rings_lock = threading.Lock()
+_fd_scan = os.scandir in os.supports_fd
+_uring = liburing is not None and _fd_scan and _uring_ok()
+_libc_statx = None
+# struct statx: u16 stx_mode at offset 28, u64 stx_size at offset 40
+_statx_unpack = struct.Struct('=28xH10xQ').unpack_from
 
 # Options
 r_dir = './example'
 f_unit = 'MB'
 invaild = [ '/.git/', '.DS_Store', 'README', '.png', '.txt', '.md' ]
+quiet = False
+cached_stat = False
+stats = False
+workers = min(32, (os.cpu_count() or 1) * 4)
+
+# Set by main() for each run, read by the scan workers
+_quiet = False
+_cached_stat = False
+_statx_flags = 0x100
+inv_dirs = set()
+inv_dir_sfx = ()
+dir_match = None
+
+# Run one scan; command line values override the Options for this call only
+def main(argv):
+    global _quiet, _cached_stat, _statx_flags, inv_dirs, inv_dir_sfx, dir_match
+    opts = parse_argv(argv)
+    _stats[:] = [ 0, 0 ]
+    d_root = opts.get('directory', r_dir)
+    unit = opts.get('unit', f_unit)
+    patterns = opts.get('exclude', invaild)
+    show_stats = opts.get('stats', stats)
+    _quiet = opts.get('quiet', quiet)
+    # Needs a directory fd and either io_uring or libc statx(); otherwise plain stat
+    _cached_stat = opts.get('cached_stat', cached_stat) and _fd_scan and (_uring or _load_statx())
+    # AT_SYMLINK_NOFOLLOW, plus AT_STATX_DONT_SYNC with --cached-stat
+    _statx_flags = 0x100 | (0x4000 if _cached_stat else 0)
+    n_workers = workers
+    if 'jobs' in opts:
+        try:
+            n_workers = int(opts['jobs'])
+        except ValueError:
+            n_workers = 0
+        if n_workers < 1:
+            sys.exit('fileinfo.py: --jobs needs a positive number')
+    # Split the patterns by kind (see README); directory patterns prune the walk
+    dir_inv = [ x for x in patterns if len(x) > 2 and x[0] == x[-1] == '/' and '/' not in x[1:-1] ]
+    inv_dirs = { x[1:-1] for x in dir_inv }
+    inv_exts = { x for x in patterns if x[:1] == '.' and '/' not in x and '.' not in x[1:] }
+    inv_sfx = tuple(x for x in patterns if x[:1] == '.' and '/' not in x and '.' in x[1:])
+    inv_names = { x for x in patterns if x[:1] != '.' and '/' not in x }
+    inv_dirs |= inv_names
+    inv_dir_sfx = tuple(inv_exts) + inv_sfx
+    dir_match = get_inv_match([ x.replace('/', os.sep) for x in patterns if x[-1:] == '/' and x not in dir_inv ])
+    path_match = get_inv_match([ x.replace('/', os.sep) for x in patterns if '/' in x and x[-1] != '/' ])
+    name_inv = bool(inv_names or inv_exts or inv_sfx or path_match)
+    try:
+        f_fmt = get_f_fmt(unit)
+    except ValueError as e:
+        sys.exit('fileinfo.py: ' + str(e))
+    txt_path = opts.get('output') or os.path.join(d_root, 'fileinfo.txt')
+    txt_dir, txt_name = os.path.split(os.path.abspath(txt_path))
+    r_len = len(d_root.rstrip(os.sep + (os.altsep or '')))
+
+    # Export
+    try:
+        job = scan_dir(d_root, True)
+    except OSError as e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR):
+            sys.exit("Error: Target directory '" + d_root + "' not found or is not a directory.")
+        sys.exit("Error: Target directory '" + d_root + "': " + e.strerror)
+    # A directory pattern found in the root path itself excludes everything
+    if any(x.replace('/', os.sep) in job[0] for x in patterns if x[-1:] == '/'):
+        job = (job[0], [], [])
+    from concurrent.futures import ThreadPoolExecutor
+    try:
+        fd = os.open(txt_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+    except OSError as e:
+        _close_rings()
+        sys.exit("Error: Output file '" + txt_path + "': " + e.strerror)
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            buf = bytearray()
+            sep = b''
+            listed = 0
+            pending = deque()
+            jobs = deque()
+            while job:
+                d_pre, files, dirs = job
+                pending.extend(dirs)
+                while pending and len(jobs) < n_workers * 4:
+                    jobs.append(pool.submit(scan_dir, pending.popleft()))
+                rel_pre = d_pre[r_len:]
+                if os.sep != '/':
+                    rel_pre = rel_pre.replace(os.sep, '/')
+                rows = []
+                add = rows.append
+                # The output file may live inside the scanned tree
+                own = txt_name if os.path.abspath(d_pre) == txt_dir else None
+                for name, r_size in files:
+                    if name == own:
+                        continue
+                    if name_inv:
+                        if name in inv_names:
+                            continue
+                        dot = name.rfind('.')
+                        if dot >= 0 and name[dot:] in inv_exts:
+                            continue
+                        if inv_sfx and name.endswith(inv_sfx):
+                            continue
+                        if path_match is not None and path_match(d_pre + name):
+                            continue
+                    add(rel_pre)
+                    add(name)
+                    add(', ')
+                    add(f_fmt(r_size))
+                    add(',\n')
+                    listed += 1
+                if rows:
+                    rows.pop()
+                    chunk = ''.join(rows).encode('utf-8', 'surrogateescape')
+                    buf += sep
+                    buf += chunk
+                    sep = b',\n'
+                    if len(buf) >= 1048576:
+                        write_all(fd, buf)
+                        del buf[:]
+                job = jobs.popleft().result() if jobs else None
+            write_all(fd, buf)
+    finally:
+        os.close(fd)
+        _close_rings()
+    _stats[0] = listed
+    if show_stats:
+        print('%d files listed, %d unreadable' % tuple(_stats))
 
-# __init__
-txt = []
-for r_file in os.listdir(r_dir):
-    r_path = r_dir +'/'+ r_file
-    if os.path.isfile(r_path):
-        if not any(x in r_path for x in invaild):
-            txt += [ '/'+ r_file +', '+ get_f_size(r_path,f_unit) ]
-    elif os.path.isdir(r_path):
-        # Get All of sub directory
-        s_dirs = [x[0] for x in os.walk(r_path)]
-        for s_dir in s_dirs:
-            for s_file in os.listdir(s_dir):
-                s_path = s_dir +'/'+ s_file
-                if os.path.isfile(s_path):
-                    if not any(x in s_path for x in invaild):
-                        txt += [ s_dir.replace(r_dir,"") +'/'+ s_file +', '+ get_f_size(s_path,f_unit) ]
-
-# Export
-txt = ',\n'.join(txt)
-txt_file = r_dir + '/fileinfo.txt'
-txt_file = open(txt_file,"w")
-txt_file.write(txt)
-txt_file.close()
+if __name__ == '__main__':
+    main(sys.argv[1:])